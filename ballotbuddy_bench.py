@@ -0,0 +1,634 @@
+#!/usr/bin/env python3
+"""
+BallotBuddy – load-testing benchmarks against a local stand-in for OpenAI.
+
+Nothing here calls the real API. `fake-openai` serves /v1/chat/completions
+(plain and streamed) with configurable latency, token rate and injected
+errors; `run` drives a running app with multi-turn conversations; `sweep`
+starts the app under each worker model against the stand-in and runs every
+concurrency level, writing one JSON report:
+
+    python3 ballotbuddy_bench.py fake-openai --port 8900 --latency 0.8 --tokens-per-second 60
+    OPENAI_BASE_URL=http://127.0.0.1:8900/v1 OPENAI_API_KEY=bench RATE_LIMIT_PER_MINUTE=0 \\
+        gunicorn -w 4 -b 127.0.0.1:8000 ballotbuddy_app:app
+    python3 ballotbuddy_bench.py run http://127.0.0.1:8000 -c 32 -d 30 --stream
+
+    python3 ballotbuddy_bench.py sweep -m sync -m gthread -m async -c 8 -c 32 -c 128 -o bench.json
+    python3 ballotbuddy_bench.py compare old.json bench.json
+
+A report holds, per worker model and concurrency level, completed requests
+per second, p50/p95/p99 of total latency and of time to first byte (first
+answer token when streaming), and counts by status and X-Cache outcome.
+Conversations are scripted voter questions with follow-ups; --repeat sets the
+share that open with a popular question verbatim (and so may hit the caches),
+the rest are made unique. To replay recorded real answers instead of the
+stand-in's, pass -e OPENAI_TRANSPORT=replay -e OPENAI_CASSETTE=<file> to sweep.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+# Worker models for `sweep`: how to start the app on {port} with {workers} processes.
+WORKER_MODELS = {
+    "sync": ["gunicorn", "-w", "{workers}", "-b", "127.0.0.1:{port}", "ballotbuddy_app:app"],
+    "gthread": [
+        "gunicorn", "-w", "{workers}", "-k", "gthread", "--threads", "16",
+        "-b", "127.0.0.1:{port}", "ballotbuddy_app:app",
+    ],
+    "async": [
+        "uvicorn", "ballotbuddy_app:asgi_app", "--workers", "{workers}",
+        "--host", "127.0.0.1", "--port", "{port}", "--no-access-log",
+    ],
+}
+
+CONVERSATIONS = [
+    [
+        "How do I register to vote in Georgia?",
+        "Can I do that online?",
+        "How do I check that my registration went through?",
+    ],
+    [
+        "What IDs are accepted to vote in Georgia?",
+        "My driver's license expired last year. Can I still use it?",
+    ],
+    [
+        "How does absentee voting by mail work in Georgia?",
+        "When is the deadline to request the ballot?",
+        "Can I drop it off instead of mailing it?",
+        "How do I track it?",
+    ],
+    [
+        "When does early voting start?",
+        "Do I have to vote at my usual precinct during early voting?",
+    ],
+    [
+        "I moved to a new county last month. Do I need to register again?",
+        "What happens if I miss the deadline?",
+        "Can I still vote at my old polling place?",
+    ],
+    [
+        "What should I do if my name is not on the list at my polling place?",
+        "How do I make sure a provisional ballot counts?",
+    ],
+    [
+        "I'm a college student from Georgia going to school out of state. How can I vote?",
+        "Does my ballot need a stamp?",
+    ],
+    [
+        "What time do the polls open on election day?",
+        "What if I'm still in line when they close?",
+    ],
+]
+
+COUNTIES = [
+    "Fulton", "Cobb", "DeKalb", "Gwinnett", "Chatham", "Clayton", "Cherokee", "Forsyth",
+    "Henry", "Richmond", "Bibb", "Muscogee", "Clarke", "Hall", "Lowndes", "Dougherty",
+]
+
+ANSWER_WORDS = (
+    "you can check your voter registration status on the My Voter Page and contact your "
+    "county election office if anything looks wrong before the deadline for this election"
+).split()
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list (None when empty)."""
+    if not sorted_values:
+        return None
+    rank = max(1, min(len(sorted_values), round(p / 100 * len(sorted_values) + 0.5)))
+    return sorted_values[rank - 1]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# ----------------- FAKE OPENAI SERVER -----------------
+
+
+class FakeOpenAI(ThreadingHTTPServer):
+    """OpenAI-compatible /v1/chat/completions with tunable latency and failures.
+
+    Each call waits a log-normally distributed time to first token around
+    `latency` seconds, then produces `answer_tokens` words at
+    `tokens_per_second` (streamed one chunk per word when asked to stream). A
+    share `error_rate` of calls fails with `error_status` instead.
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, latency=0.5, jitter=0.3, tokens_per_second=50.0,
+                 answer_tokens=120, error_rate=0.0, error_status=500):
+        super().__init__(address, FakeOpenAIHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.tokens_per_second = tokens_per_second
+        self.answer_tokens = answer_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.calls = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def first_token_delay(self):
+        if self.latency <= 0:
+            return 0.0
+        if self.jitter <= 0:
+            return self.latency
+        # Median `latency`, with a long right tail like real model calls.
+        return random.lognormvariate(0, self.jitter) * self.latency
+
+    def handle_error(self, request, client_address):
+        # The app hanging up mid-call (e.g. stopped between sweep cells) is expected.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def answer(self):
+        words = [ANSWER_WORDS[i % len(ANSWER_WORDS)] for i in range(self.answer_tokens)]
+        return [w if i == 0 else " " + w for i, w in enumerate(words)]
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the SDK's connection pool expects
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        if self.path.rstrip("/") not in ("/v1/chat/completions", "/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+            return
+        server = self.server
+        with server._lock:
+            server.calls += 1
+            failed = random.random() < server.error_rate
+            server.errors += failed
+        time.sleep(server.first_token_delay())
+        if failed:
+            self._send_json(
+                server.error_status,
+                {"error": {"message": "injected failure", "type": "server_error", "code": None}},
+            )
+            return
+
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in body.get("messages", [])) // 4
+        tokens = server.answer()
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(tokens),
+            "total_tokens": prompt_tokens + len(tokens),
+            "prompt_tokens_details": {"cached_tokens": 0},
+        }
+        meta = {
+            "id": "chatcmpl-" + uuid.uuid4().hex[:24],
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "system_fingerprint": "fake",
+        }
+        pause = 1 / server.tokens_per_second if server.tokens_per_second > 0 else 0
+
+        if not body.get("stream"):
+            time.sleep(pause * len(tokens))
+            message = {"role": "assistant", "content": "".join(tokens)}
+            self._send_json(
+                200,
+                dict(meta, object="chat.completion", usage=usage,
+                     choices=[{"index": 0, "message": message, "finish_reason": "stop"}]),
+            )
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        chunk = dict(meta, object="chat.completion.chunk")
+        for i, token in enumerate(tokens):
+            delta = {"role": "assistant", "content": token} if i == 0 else {"content": token}
+            frame = dict(chunk, choices=[{"index": 0, "delta": delta, "finish_reason": None}])
+            self._chunk(b"data: " + json.dumps(frame).encode("utf-8") + b"\n\n")
+            time.sleep(pause)
+        last = dict(chunk, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        self._chunk(b"data: " + json.dumps(last).encode("utf-8") + b"\n\n")
+        if (body.get("stream_options") or {}).get("include_usage"):
+            self._chunk(b"data: " + json.dumps(dict(chunk, choices=[], usage=usage)).encode("utf-8") + b"\n\n")
+        self._chunk(b"data: [DONE]\n\n")
+        self._chunk(b"")
+
+
+def start_fake_openai(port=0, **settings):
+    """Serve FakeOpenAI on a background thread; returns the server (see .server_port)."""
+    server = FakeOpenAI(("127.0.0.1", port), **settings)
+    threading.Thread(target=server.serve_forever, name="fake-openai", daemon=True).start()
+    return server
+
+
+# ----------------- LOAD GENERATOR -----------------
+
+
+def encode_form(fields):
+    """(body, content type) for a multipart/form-data request, as the browser sends it."""
+    boundary = "bench" + uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+        )
+    parts.append(f"--{boundary}--\r\n")
+    return "".join(parts).encode("utf-8"), f"multipart/form-data; boundary={boundary}"
+
+
+def make_conversation(rng, repeat):
+    """One scripted conversation; unless repeated verbatim, its turns are made unique."""
+    turns = list(rng.choice(CONVERSATIONS))
+    if rng.random() >= repeat:
+        county = rng.choice(COUNTIES)
+        turns[0] = f"I live in {county} County, ZIP 3{rng.randrange(10**4):04d}. {turns[0]}"
+    return turns
+
+
+class VirtualUser(threading.Thread):
+    """Closed-loop client: one request at a time, conversations back to back."""
+
+    def __init__(self, target, results, stop_at, stream, repeat, think, seed):
+        super().__init__(daemon=True)
+        url = urlsplit(target)
+        self.host, self.port = url.hostname, url.port or 80
+        self.results = results
+        self.stop_at = stop_at
+        self.path = "/api/chat/stream" if stream else "/api/chat"
+        self.stream = stream
+        self.repeat = repeat
+        self.think = think
+        self.rng = random.Random(seed)
+        # Each user gets its own address so per-IP rate limits behave as in production.
+        self.address = f"10.{seed // 65536 % 256}.{seed // 256 % 256}.{seed % 256}"
+        self.conn = None
+
+    @staticmethod
+    def stateless(history, question):
+        # Like the page: send the whole history and ask the server to keep it from now on.
+        messages = json.dumps(history + [{"role": "user", "content": question}])
+        return {"messages": messages, "start_session": "1"}
+
+    def run(self):
+        while time.monotonic() < self.stop_at:
+            history = []
+            session_id = None
+            for question in make_conversation(self.rng, self.repeat):
+                if time.monotonic() >= self.stop_at:
+                    return
+                if session_id:
+                    fields = {"session_id": session_id, "message": question}
+                else:
+                    fields = self.stateless(history, question)
+                result = self.ask(fields)
+                if result["status"] == 409:  # session expired on this worker: resend it all
+                    result = self.ask(self.stateless(history, question))
+                self.results.append(result)
+                if result["status"] != 200 or not result.get("answer"):
+                    break
+                session_id = result.get("session_id") or session_id
+                history += [
+                    {"role": "user", "content": question},
+                    {"role": "assistant", "content": result["answer"]},
+                ]
+                if self.think:
+                    time.sleep(self.rng.expovariate(1 / self.think))
+
+    def ask(self, fields):
+        body, content_type = encode_form(fields)
+        headers = {"Content-Type": content_type, "X-Forwarded-For": self.address}
+        started = time.monotonic()
+        result = {"started": started, "turn": "follow-up" if "session_id" in fields else "opening"}
+        try:
+            if self.conn is None:
+                self.conn = HTTPConnection(self.host, self.port, timeout=120)
+            self.conn.request("POST", self.path, body, headers)
+            response = self.conn.getresponse()
+            result["status"] = response.status
+            result["cache"] = response.getheader("X-Cache") or ""
+            if self.stream and response.status == 200:
+                self.read_stream(response, started, result)
+            else:
+                raw = response.read()
+                result["ttfb"] = time.monotonic() - started
+                try:
+                    data = json.loads(raw)
+                except ValueError:
+                    data = {}
+                result["answer"] = data.get("answer") if not data.get("error") else None
+                result["session_id"] = data.get("session_id")
+        except (OSError, ValueError) as e:
+            result.update(status=0, error=type(e).__name__)
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+        result["latency"] = time.monotonic() - started
+        return result
+
+    @staticmethod
+    def read_stream(response, started, result):
+        event = None
+        for line in response:
+            line = line.decode("utf-8").rstrip("\r\n")
+            if line.startswith("event: "):
+                event = line[7:]
+            elif line.startswith("data: "):
+                if "ttfb" not in result:
+                    result["ttfb"] = time.monotonic() - started
+                if event == "done":
+                    data = json.loads(line[6:])
+                    result["answer"] = data.get("answer")
+                    result["session_id"] = data.get("session_id")
+                elif event == "error":
+                    result["status"] = "stream-error"
+
+
+def run_load(target, concurrency, duration, stream=False, repeat=0.2, think=0.0, warmup=2.0, seed=0):
+    """Drive `target` with `concurrency` virtual users; returns the summary dict."""
+    results = []
+    started = time.monotonic()
+    stop_at = started + warmup + duration
+    users = [
+        VirtualUser(target, results, stop_at, stream, repeat, think, seed * 10000 + i)
+        for i in range(concurrency)
+    ]
+    for user in users:
+        user.start()
+    for user in users:
+        user.join(stop_at - time.monotonic() + 130)
+    measured = [r for r in results if r["started"] >= started + warmup]
+    return summarize(measured, duration, concurrency, stream)
+
+
+def summarize(results, duration, concurrency, stream):
+    ok = [r for r in results if r["status"] == 200]
+    statuses, caches = {}, {}
+    for r in results:
+        statuses[str(r["status"])] = statuses.get(str(r["status"]), 0) + 1
+        if r["status"] == 200:
+            caches[r["cache"] or "none"] = caches.get(r["cache"] or "none", 0) + 1
+
+    def latencies(key, rows):
+        values = sorted(r[key] for r in rows if key in r)
+        return {
+            f"p{p}": round(percentile(values, p) * 1000, 1) if values else None
+            for p in (50, 95, 99)
+        } | {"max": round(values[-1] * 1000, 1) if values else None}
+
+    return {
+        "concurrency": concurrency,
+        "stream": stream,
+        "duration_s": duration,
+        "requests": len(results),
+        "completed": len(ok),
+        "throughput_rps": round(len(ok) / duration, 2),
+        "status": statuses,
+        "cache": caches,
+        "latency_ms": latencies("latency", ok),
+        "ttfb_ms": latencies("ttfb", ok),
+        "opening_latency_ms": latencies("latency", [r for r in ok if r["turn"] == "opening"]),
+        "follow_up_latency_ms": latencies("latency", [r for r in ok if r["turn"] == "follow-up"]),
+    }
+
+
+# ----------------- SWEEP -----------------
+
+
+def wait_until_ready(port, proc, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"app exited with status {proc.returncode}")
+        try:
+            conn = HTTPConnection("127.0.0.1", port, timeout=2)
+            conn.request("GET", "/api/stats")
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"app did not answer on port {port} within {timeout}s")
+
+
+def start_app(model, workers, fake_port, state_dir, extra_env):
+    """Start the app under `model` against the stand-in; returns (process, port)."""
+    port = free_port()
+    argv = [a.format(workers=workers, port=port) for a in WORKER_MODELS[model]]
+    env = dict(
+        os.environ,
+        OPENAI_BASE_URL=f"http://127.0.0.1:{fake_port}/v1",
+        OPENAI_API_KEY="bench",
+        PREWARM_TOPICS="0",
+        CACHE_SQLITE_PATH=os.path.join(state_dir, "cache.sqlite3"),
+        SEMANTIC_CACHE_PATH=os.path.join(state_dir, "semantic.npz"),
+        ATTACH_STORE_DIR=os.path.join(state_dir, "files"),
+        REQUEST_LOG_DIR=os.path.join(state_dir, "requests"),
+        WARM_LIST_PATH="",
+    )
+    env.update(extra_env)
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.Popen(argv, cwd=here, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        wait_until_ready(port, proc)
+    except RuntimeError:
+        stop_app(proc)
+        raise
+    return proc, port
+
+
+def stop_app(proc):
+    proc.terminate()
+    try:
+        proc.wait(15)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def sweep(models, levels, workers, duration, stream, repeat, think, warmup, fake_settings, app_env):
+    """Every (worker model, concurrency level) cell on a fresh app with empty caches."""
+    fake = start_fake_openai(**fake_settings)
+    report = {
+        "version": 1,
+        "revision": git_revision(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "settings": {
+            "workers": workers, "duration_s": duration, "warmup_s": warmup, "stream": stream,
+            "repeat": repeat, "think_s": think, "fake_openai": fake_settings, "app_env": app_env,
+        },
+        "results": [],
+    }
+    try:
+        for model in models:
+            for level in levels:
+                with tempfile.TemporaryDirectory(prefix="ballotbuddy-bench-") as state_dir:
+                    proc, port = start_app(model, workers, fake.server_port, state_dir, app_env)
+                    try:
+                        calls_before = fake.calls
+                        cell = run_load(f"http://127.0.0.1:{port}", level, duration, stream,
+                                        repeat, think, warmup)
+                        cell["upstream_calls"] = fake.calls - calls_before
+                    finally:
+                        stop_app(proc)
+                cell["model"] = model
+                report["results"].append(cell)
+                print(
+                    f"{model:8} c={level:<4} {cell['throughput_rps']:8.1f} req/s  "
+                    f"p50={cell['latency_ms']['p50']} p95={cell['latency_ms']['p95']} "
+                    f"p99={cell['latency_ms']['p99']} ms  status={cell['status']}",
+                    file=sys.stderr,
+                )
+    finally:
+        fake.shutdown()
+    return report
+
+
+def compare(old, new):
+    """Lines of throughput and p95 change per cell present in both reports."""
+    before = {(r["model"], r["concurrency"], r["stream"]): r for r in old["results"]}
+    lines = [f"{old.get('revision')} -> {new.get('revision')}"]
+    for r in new["results"]:
+        o = before.get((r["model"], r["concurrency"], r["stream"]))
+        if o is None:
+            continue
+
+        def change(a, b):
+            return f"{(b - a) / a * 100:+.1f}%" if a and b is not None else "n/a"
+
+        lines.append(
+            f"{r['model']:8} c={r['concurrency']:<4} "
+            f"throughput {o['throughput_rps']} -> {r['throughput_rps']} req/s "
+            f"({change(o['throughput_rps'], r['throughput_rps'])})  "
+            f"p95 {o['latency_ms']['p95']} -> {r['latency_ms']['p95']} ms "
+            f"({change(o['latency_ms']['p95'], r['latency_ms']['p95'])})"
+        )
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def fake_options(cmd):
+        cmd.add_argument("--latency", type=float, default=0.5, help="median seconds to first token")
+        cmd.add_argument("--jitter", type=float, default=0.3, help="log-normal sigma of that delay")
+        cmd.add_argument("--tokens-per-second", type=float, default=50.0)
+        cmd.add_argument("--answer-tokens", type=int, default=120)
+        cmd.add_argument("--error-rate", type=float, default=0.0)
+        cmd.add_argument("--error-status", type=int, default=500)
+
+    def load_options(cmd):
+        cmd.add_argument("-d", "--duration", type=float, default=20.0, help="measured seconds")
+        cmd.add_argument("--warmup", type=float, default=2.0, help="unmeasured seconds first")
+        cmd.add_argument("--stream", action="store_true", help="use /api/chat/stream")
+        cmd.add_argument("--repeat", type=float, default=0.2,
+                         help="share of conversations opening with a popular question verbatim")
+        cmd.add_argument("--think", type=float, default=0.0, help="mean seconds between turns")
+
+    fake_cmd = sub.add_parser("fake-openai", help="serve the OpenAI stand-in")
+    fake_cmd.add_argument("--port", type=int, default=8900)
+    fake_options(fake_cmd)
+
+    run_cmd = sub.add_parser("run", help="load a running app at one concurrency level")
+    run_cmd.add_argument("target", help="base URL, e.g. http://127.0.0.1:8000")
+    run_cmd.add_argument("-c", "--concurrency", type=int, default=16)
+    load_options(run_cmd)
+
+    sweep_cmd = sub.add_parser("sweep", help="start the app per worker model and concurrency level")
+    sweep_cmd.add_argument("-m", "--model", action="append", choices=sorted(WORKER_MODELS))
+    sweep_cmd.add_argument("-c", "--concurrency", type=int, action="append")
+    sweep_cmd.add_argument("-w", "--workers", type=int, default=4)
+    sweep_cmd.add_argument("-e", "--env", action="append", default=[], metavar="NAME=VALUE",
+                           help="extra app setting, e.g. CACHE_BACKEND=sqlite")
+    sweep_cmd.add_argument("-o", "--output", default="-", help="report file (default stdout)")
+    load_options(sweep_cmd)
+    fake_options(sweep_cmd)
+
+    compare_cmd = sub.add_parser("compare", help="throughput and p95 changes between two reports")
+    compare_cmd.add_argument("old")
+    compare_cmd.add_argument("new")
+    args = parser.parse_args(argv)
+
+    if args.command in ("fake-openai", "sweep"):
+        fake_settings = dict(
+            latency=args.latency, jitter=args.jitter, tokens_per_second=args.tokens_per_second,
+            answer_tokens=args.answer_tokens, error_rate=args.error_rate,
+            error_status=args.error_status,
+        )
+
+    if args.command == "fake-openai":
+        server = FakeOpenAI(("127.0.0.1", args.port), **fake_settings)
+        print(f"OpenAI stand-in on http://127.0.0.1:{server.server_port}/v1", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    elif args.command == "run":
+        summary = run_load(args.target, args.concurrency, args.duration, args.stream,
+                           args.repeat, args.think, args.warmup)
+        print(json.dumps(summary, indent=2))
+    elif args.command == "sweep":
+        app_env = dict(
+            {"RATE_LIMIT_PER_MINUTE": "0"},
+            **dict(item.split("=", 1) for item in args.env),
+        )
+        report = sweep(
+            args.model or ["sync", "async"], args.concurrency or [8, 32], args.workers,
+            args.duration, args.stream, args.repeat, args.think, args.warmup, fake_settings, app_env,
+        )
+        text = json.dumps(report, indent=2)
+        if args.output == "-":
+            print(text)
+        else:
+            with open(args.output, "w", encoding="utf-8") as f:
+                f.write(text + "\n")
+    else:
+        with open(args.old, encoding="utf-8") as f:
+            old = json.load(f)
+        with open(args.new, encoding="utf-8") as f:
+            new = json.load(f)
+        print("\n".join(compare(old, new)))
+
+
+if __name__ == "__main__":
+    main()
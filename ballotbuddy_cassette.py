@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""
+BallotBuddy – record and replay OpenAI API traffic.
+
+A cassette is an HTTP transport for the OpenAI SDK's client. In "record" mode
+it passes every call through to the API and appends the response, with the
+arrival time of each chunk, to a cassette file; in "replay" mode it answers
+from that file without any network access, optionally at the recorded pace:
+
+    OPENAI_TRANSPORT=record OPENAI_CASSETTE=election.cassette python3 ballotbuddy_app.py
+    OPENAI_TRANSPORT=replay OPENAI_CASSETTE=election.cassette OPENAI_REPLAY_SPEED=0 \\
+        gunicorn -w 4 ballotbuddy_app:app
+    python3 ballotbuddy_cassette.py list election.cassette
+
+Requests are matched on method, path and the JSON body (model, messages,
+stream, ...), so a replay is deterministic as long as the app builds the same
+prompts. A request recorded several times is answered with each recording in
+turn; one that was never recorded gets a 404 that the SDK does not retry.
+Authorization headers are never written.
+
+The file is gzip-compressed JSON lines, one gzip member per recording so
+appends are cheap and a crash loses at most the recording in progress:
+
+    {"key", "request": {"model", "stream", "messages"}, "status", "headers",
+     "ttfb", "chunks": [[seconds since the request, text or base64, "b64"?], ...]}
+"""
+
+import argparse
+import asyncio
+import base64
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+try:
+    import httpx
+except ImportError:  # newer openai releases are built on httpx2, which has the same API
+    import httpx2 as httpx
+
+KEPT_HEADERS = ("content-type", "content-encoding", "x-request-id", "openai-processing-ms")
+
+
+def request_key(request):
+    """Stable hash of what decides the answer: method, path and the JSON body."""
+    body = request.read()
+    try:
+        body = json.dumps(json.loads(body), sort_keys=True, separators=(",", ":")).encode("utf-8")
+    except ValueError:
+        pass
+    h = hashlib.sha256(f"{request.method} {request.url.path}\n".encode("utf-8"))
+    h.update(body)
+    return h.hexdigest()
+
+
+def request_summary(request):
+    try:
+        body = json.loads(request.read())
+    except ValueError:
+        return {}
+    return {
+        "model": body.get("model"),
+        "stream": bool(body.get("stream")),
+        "messages": len(body.get("messages") or []),
+    }
+
+
+def encode_chunk(offset, data):
+    try:
+        return [round(offset, 4), data.decode("utf-8")]
+    except UnicodeDecodeError:  # compressed bodies, or a character split across chunks
+        return [round(offset, 4), base64.b64encode(data).decode("ascii"), "b64"]
+
+
+def ends_stream(tail):
+    # The SDK stops reading (and closes) at the SSE terminator, so that counts as complete.
+    return b"data: [DONE]" in tail
+
+
+def decode_chunk(chunk):
+    return base64.b64decode(chunk[1]) if len(chunk) > 2 else chunk[1].encode("utf-8")
+
+
+def read_cassette(path):
+    """Recordings in the order they were made (empty if the file does not exist)."""
+    if not os.path.exists(path):
+        return []
+    records = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                if line.strip():
+                    records.append(json.loads(line))
+        except (EOFError, gzip.BadGzipFile, ValueError):
+            pass  # a recording cut short by a crash; keep everything before it
+    return records
+
+
+class Cassette:
+    """Recordings for one cassette file, shared by a sync and an async transport.
+
+    `speed` scales the recorded delays on replay: 1 reproduces them, 0 answers
+    at once (to measure only the app's own overhead), 2 is twice as slow.
+    """
+
+    def __init__(self, path, mode, speed=1.0):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"cassette mode must be record or replay, not {mode!r}")
+        self.path = path
+        self.mode = mode
+        self.speed = speed
+        self.recordings = defaultdict(list)
+        for record in read_cassette(path) if mode == "replay" else []:
+            self.recordings[record["key"]].append(record)
+        self._next = defaultdict(int)
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+        self._lock = threading.Lock()
+
+    def transport(self):
+        if self.mode == "record":
+            return RecordingTransport(self, httpx.HTTPTransport())
+        return ReplayTransport(self)
+
+    def async_transport(self):
+        if self.mode == "record":
+            return AsyncRecordingTransport(self, httpx.AsyncHTTPTransport())
+        return AsyncReplayTransport(self)
+
+    # --- replay ---
+
+    def lookup(self, request):
+        """The next recording for `request`, or None (counted as a miss)."""
+        key = request_key(request)
+        with self._lock:
+            found = self.recordings.get(key)
+            if not found:
+                self.misses += 1
+                return None
+            record = found[self._next[key] % len(found)]
+            self._next[key] += 1
+            self.hits += 1
+        return record
+
+    def miss_response(self, request):
+        return httpx.Response(
+            404,
+            json={
+                "error": {
+                    "message": f"no recording for this request in {self.path}",
+                    "type": "cassette_miss",
+                    "code": request_key(request)[:16],
+                }
+            },
+            request=request,
+        )
+
+    # --- record ---
+
+    def save(self, request, response, ttfb, chunks):
+        record = {
+            "key": request_key(request),
+            "request": request_summary(request),
+            "status": response.status_code,
+            "headers": {k: v for k, v in response.headers.items() if k.lower() in KEPT_HEADERS},
+            "ttfb": round(ttfb, 4),
+            "chunks": chunks,
+        }
+        line = (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+        with self._lock:
+            # Each append is its own gzip member; readers see one concatenated stream.
+            with open(self.path, "ab") as f:
+                f.write(gzip.compress(line))
+            self.recorded += 1
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "path": self.path,
+            "speed": self.speed,
+            "recordings": sum(len(v) for v in self.recordings.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "recorded": self.recorded,
+        }
+
+
+# ----------------- REPLAY -----------------
+
+
+class ReplayStream(httpx.SyncByteStream):
+    def __init__(self, chunks, started, speed):
+        self.chunks = chunks
+        self.started = started
+        self.speed = speed
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            delay = self.started + chunk[0] * self.speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            yield decode_chunk(chunk)
+
+
+class AsyncReplayStream(httpx.AsyncByteStream):
+    def __init__(self, chunks, started, speed):
+        self.chunks = chunks
+        self.started = started
+        self.speed = speed
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            delay = self.started + chunk[0] * self.speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            yield decode_chunk(chunk)
+
+
+class ReplayTransport(httpx.BaseTransport):
+    def __init__(self, cassette):
+        self.cassette = cassette
+
+    def handle_request(self, request):
+        started = time.monotonic()
+        record = self.cassette.lookup(request)
+        if record is None:
+            return self.cassette.miss_response(request)
+        if record["ttfb"] * self.cassette.speed > 0:
+            time.sleep(record["ttfb"] * self.cassette.speed)
+        return httpx.Response(
+            record["status"],
+            headers=record["headers"],
+            stream=ReplayStream(record["chunks"], started, self.cassette.speed),
+            request=request,
+        )
+
+
+class AsyncReplayTransport(httpx.AsyncBaseTransport):
+    def __init__(self, cassette):
+        self.cassette = cassette
+
+    async def handle_async_request(self, request):
+        started = time.monotonic()
+        record = self.cassette.lookup(request)
+        if record is None:
+            return self.cassette.miss_response(request)
+        if record["ttfb"] * self.cassette.speed > 0:
+            await asyncio.sleep(record["ttfb"] * self.cassette.speed)
+        return httpx.Response(
+            record["status"],
+            headers=record["headers"],
+            stream=AsyncReplayStream(record["chunks"], started, self.cassette.speed),
+            request=request,
+        )
+
+
+# ----------------- RECORD -----------------
+
+
+class RecordingStream(httpx.SyncByteStream):
+    """Passes chunks through as they arrive and saves the recording once fully read."""
+
+    def __init__(self, cassette, request, response, started, ttfb):
+        self.cassette = cassette
+        self.request = request
+        self.response = response
+        self.started = started
+        self.ttfb = ttfb
+        self.chunks = []
+        self.complete = False
+        self._tail = b""
+
+    def __iter__(self):
+        for data in self.response.stream:
+            self.chunks.append(encode_chunk(time.monotonic() - self.started, data))
+            self._tail = self._tail[-16:] + data
+            self.complete = ends_stream(self._tail)
+            yield data
+        self.complete = True
+
+    def close(self):
+        self.response.close()
+        if self.complete:  # an abandoned stream would replay as a truncated answer
+            self.cassette.save(self.request, self.response, self.ttfb, self.chunks)
+
+
+class AsyncRecordingStream(httpx.AsyncByteStream):
+    def __init__(self, cassette, request, response, started, ttfb):
+        self.cassette = cassette
+        self.request = request
+        self.response = response
+        self.started = started
+        self.ttfb = ttfb
+        self.chunks = []
+        self.complete = False
+        self._tail = b""
+
+    async def __aiter__(self):
+        async for data in self.response.stream:
+            self.chunks.append(encode_chunk(time.monotonic() - self.started, data))
+            self._tail = self._tail[-16:] + data
+            self.complete = ends_stream(self._tail)
+            yield data
+        self.complete = True
+
+    async def aclose(self):
+        await self.response.aclose()
+        if self.complete:
+            self.cassette.save(self.request, self.response, self.ttfb, self.chunks)
+
+
+class RecordingTransport(httpx.BaseTransport):
+    def __init__(self, cassette, inner):
+        self.cassette = cassette
+        self.inner = inner
+
+    def handle_request(self, request):
+        started = time.monotonic()
+        response = self.inner.handle_request(request)
+        stream = RecordingStream(self.cassette, request, response, started, time.monotonic() - started)
+        return httpx.Response(
+            response.status_code,
+            headers=response.headers,
+            stream=stream,
+            request=request,
+            extensions=response.extensions,
+        )
+
+    def close(self):
+        self.inner.close()
+
+
+class AsyncRecordingTransport(httpx.AsyncBaseTransport):
+    def __init__(self, cassette, inner):
+        self.cassette = cassette
+        self.inner = inner
+
+    async def handle_async_request(self, request):
+        started = time.monotonic()
+        response = await self.inner.handle_async_request(request)
+        stream = AsyncRecordingStream(
+            self.cassette, request, response, started, time.monotonic() - started
+        )
+        return httpx.Response(
+            response.status_code,
+            headers=response.headers,
+            stream=stream,
+            request=request,
+            extensions=response.extensions,
+        )
+
+    async def aclose(self):
+        await self.inner.aclose()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    list_cmd = sub.add_parser("list", help="one line per recording")
+    list_cmd.add_argument("cassette")
+    args = parser.parse_args(argv)
+
+    records = read_cassette(args.cassette)
+    for record in records:
+        request = record.get("request", {})
+        size = sum(len(decode_chunk(c)) for c in record["chunks"])
+        elapsed = record["chunks"][-1][0] if record["chunks"] else record["ttfb"]
+        print(
+            f"{record['key'][:12]}  {record['status']}  {request.get('model')}  "
+            f"{'stream' if request.get('stream') else 'json  '}  {request.get('messages')} msgs  "
+            f"ttfb {record['ttfb'] * 1000:.0f} ms  total {elapsed * 1000:.0f} ms  {size} bytes"
+        )
+    print(f"{len(records)} recordings, {len({r['key'] for r in records})} distinct requests")
+
+
+if __name__ == "__main__":
+    main()
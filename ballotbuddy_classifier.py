@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+BallotBuddy – local off-topic pre-classifier.
+
+A logistic regression over hashed word and word-pair features, trained offline
+from labelled questions and shipped as a small binary file, so the app can
+answer obviously unrelated questions ("write me a poem") with a canned refusal
+instead of a model call:
+
+    python3 ballotbuddy_classifier.py train offtopic_training.tsv -o ballotbuddy_classifier.bin
+    python3 ballotbuddy_classifier.py score ballotbuddy_classifier.bin "recipe for peach cobbler"
+    python3 ballotbuddy_classifier.py eval ballotbuddy_classifier.bin offtopic_training.tsv -t 0.9
+
+Training data is one "on"/"off" label, a tab and a question per line; lines
+starting with # are ignored.
+
+The model file is little-endian:
+
+    header     magic, version, bucket count, bias
+    weights    f32 per feature bucket
+"""
+
+import argparse
+import math
+import os
+import random
+import struct
+import sys
+import time
+from array import array
+
+from ballotbuddy_index import term_hash, tokenize
+
+MAGIC = b"BBC1"
+VERSION = 1
+HEADER = struct.Struct("<4sIIf")
+
+BUCKETS = 1 << 14
+
+
+def features(text):
+    """Feature strings for a question: word unigrams and adjacent word pairs."""
+    tokens = tokenize(text)
+    feats = ["u:" + t for t in tokens]
+    feats += ["b:" + a + "_" + b for a, b in zip(tokens, tokens[1:])]
+    return feats
+
+
+def buckets(text, n_buckets):
+    return {term_hash(f) % n_buckets for f in features(text)}
+
+
+# ----------------- SCORING -----------------
+
+
+class TopicClassifier:
+    """Loaded model; score() is pure arithmetic and safe to share across threads."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            magic, version, self.n_buckets, self.bias = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"{path} is not a BallotBuddy classifier (version {VERSION})")
+            self.weights = array("f")
+            self.weights.frombytes(f.read(self.n_buckets * 4))
+        if sys.byteorder != "little":
+            self.weights.byteswap()
+
+    def score(self, text):
+        """Probability that `text` is off-topic, from 0 to 1."""
+        z = self.bias + sum(self.weights[i] for i in buckets(text, self.n_buckets))
+        return 1.0 / (1.0 + math.exp(-max(-30.0, min(30.0, z))))
+
+
+# ----------------- TRAINING -----------------
+
+
+def load_examples(path):
+    """[(text, 1 if off-topic else 0)] from a labelled TSV file."""
+    examples = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            label, _, text = line.partition("\t")
+            if label not in ("on", "off") or not text:
+                raise ValueError(f"bad training line: {line!r}")
+            examples.append((text, 1 if label == "off" else 0))
+    return examples
+
+
+def train(examples, n_buckets=BUCKETS, epochs=40, rate=0.3, l2=1e-4, seed=0):
+    """(weights, bias) fitted by SGD on the log loss with L2 regularisation.
+
+    The bias stays at 0: a question made only of words the model has never
+    seen scores 0.5, so only learned evidence can push it past a refusal
+    threshold.
+    """
+    rows = [(sorted(buckets(text, n_buckets)), y) for text, y in examples]
+    weights = [0.0] * n_buckets
+    bias = 0.0
+    rng = random.Random(seed)
+    for _ in range(epochs):
+        rng.shuffle(rows)
+        for idx, y in rows:
+            z = bias + sum(weights[i] for i in idx)
+            p = 1.0 / (1.0 + math.exp(-max(-30.0, min(30.0, z))))
+            g = p - y
+            for i in idx:
+                weights[i] -= rate * (g + l2 * weights[i])
+    return weights, bias
+
+
+def write_model(weights, bias, out_path):
+    blob = array("f", weights)
+    if sys.byteorder != "little":
+        blob.byteswap()
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(weights), bias))
+        f.write(blob.tobytes())
+    # Running workers reload the file by mtime, so never let them see half of it.
+    os.replace(tmp_path, out_path)
+
+
+def evaluate(model, examples, threshold):
+    """Counts of refusals at `threshold` against the labels, plus mean scoring time."""
+    counts = {"refused_off": 0, "refused_on": 0, "passed_off": 0, "passed_on": 0}
+    started = time.perf_counter()
+    for text, y in examples:
+        refused = model.score(text) >= threshold
+        counts[("refused_" if refused else "passed_") + ("off" if y else "on")] += 1
+    counts["mean_ms"] = round((time.perf_counter() - started) * 1000 / max(1, len(examples)), 4)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    train_cmd = sub.add_parser("train", help="fit a model from labelled questions")
+    train_cmd.add_argument("data")
+    train_cmd.add_argument("-o", "--output", default="ballotbuddy_classifier.bin")
+    score_cmd = sub.add_parser("score", help="off-topic probability of one question")
+    score_cmd.add_argument("model")
+    score_cmd.add_argument("question")
+    eval_cmd = sub.add_parser("eval", help="refusals at a threshold against labelled questions")
+    eval_cmd.add_argument("model")
+    eval_cmd.add_argument("data")
+    eval_cmd.add_argument("-t", "--threshold", type=float, default=0.9)
+    args = parser.parse_args(argv)
+
+    if args.command == "train":
+        examples = load_examples(args.data)
+        weights, bias = train(examples)
+        write_model(weights, bias, args.output)
+        print(f"wrote {args.output}: {len(examples)} examples, {len(weights)} buckets")
+    elif args.command == "score":
+        print(f"{TopicClassifier(args.model).score(args.question):.4f}")
+    else:
+        counts = evaluate(TopicClassifier(args.model), load_examples(args.data), args.threshold)
+        print(" ".join(f"{k}={v}" for k, v in counts.items()))
+
+
+if __name__ == "__main__":
+    main()
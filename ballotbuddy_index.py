@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+BallotBuddy – local BM25 retrieval over official Georgia election pages.
+
+Build the index offline from a local snapshot of sos.ga.gov, mvp.sos.ga.gov
+and georgia.gov pages (saved .html/.htm/.txt/.md files):
+
+    python3 ballotbuddy_index.py build docs_snapshot -o ga_index.bin
+    python3 ballotbuddy_index.py search ga_index.bin "absentee ballot deadline"
+
+Page URLs and titles come from an optional docs_snapshot/manifest.json
+({"file.html": {"url": ..., "title": ...}}), else from the page's canonical
+link and <title>.
+
+The index is one flat little-endian file that the app opens with mmap, so
+every gunicorn worker shares the same pages through the OS page cache:
+
+    header     magic, version, doc/term counts, BM25 params, section offsets
+    terms      (term hash u64, first posting u32, df u32), sorted by hash
+    postings   (doc id u32, term frequency u32)
+    doclens    u32 per passage
+    docoffs    u64 per passage + 1, into the text section
+    text       one JSON object per passage: {"title", "url", "text"}
+"""
+
+import argparse
+import hashlib
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+from collections import Counter, defaultdict
+from html.parser import HTMLParser
+
+MAGIC = b"BBX1"
+VERSION = 1
+HEADER = struct.Struct("<4sIIIfffI5Q")
+TERM = struct.Struct("<QII")
+POSTING = struct.Struct("<II")
+
+PASSAGE_WORDS = 120
+PASSAGE_OVERLAP = 30
+
+STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from how i if in is it its me my "
+    "of on or our so that the their there this to was what when where which who "
+    "will with you your".split()
+)
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    """Lowercase word tokens without stopwords, with plurals folded."""
+    tokens = []
+    for word in _WORD_RE.findall(text.lower()):
+        if word in STOPWORDS:
+            continue
+        if len(word) > 4 and word.endswith("ies"):
+            word = word[:-3] + "y"
+        elif len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+
+def term_hash(term):
+    return int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+# ----------------- READING -----------------
+
+
+class BM25Index:
+    """Read-only view of an index file through mmap; safe to share across threads."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (
+            magic,
+            version,
+            self.n_docs,
+            self.n_terms,
+            self.avgdl,
+            self.k1,
+            self.b,
+            _,
+            self._terms_off,
+            self._postings_off,
+            self._doclens_off,
+            self._docoffs_off,
+            self._text_off,
+        ) = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a BallotBuddy index (version {VERSION})")
+
+    def close(self):
+        self._mm.close()
+
+    def _lookup(self, term):
+        """(first posting, df) for a term, by binary search over the sorted hash table."""
+        target = term_hash(term)
+        lo, hi = 0, self.n_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            h, start, df = TERM.unpack_from(self._mm, self._terms_off + mid * TERM.size)
+            if h < target:
+                lo = mid + 1
+            elif h > target:
+                hi = mid
+            else:
+                return start, df
+        return None
+
+    def passage(self, doc_id):
+        start, end = struct.unpack_from("<QQ", self._mm, self._docoffs_off + doc_id * 8)
+        return json.loads(self._mm[self._text_off + start : self._text_off + end])
+
+    def search(self, query, k=4):
+        """Top-k passages as dicts with "title", "url", "text" and "score"."""
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            found = self._lookup(term)
+            if found is None:
+                continue
+            start, df = found
+            idf = math.log(1 + (self.n_docs - df + 0.5) / (df + 0.5))
+            offset = self._postings_off + start * POSTING.size
+            for doc_id, tf in POSTING.iter_unpack(self._mm[offset : offset + df * POSTING.size]):
+                (dl,) = struct.unpack_from("<I", self._mm, self._doclens_off + doc_id * 4)
+                norm = self.k1 * (1 - self.b + self.b * dl / self.avgdl)
+                scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        results = []
+        for doc_id, score in heapq.nlargest(k, scores.items(), key=lambda item: item[1]):
+            passage = self.passage(doc_id)
+            passage["score"] = round(score, 3)
+            results.append(passage)
+        return results
+
+
+# ----------------- BUILDING -----------------
+
+
+class _TextExtractor(HTMLParser):
+    SKIP = {"script", "style", "nav", "header", "footer", "noscript", "svg", "form"}
+    BLOCK = {"p", "div", "li", "br", "h1", "h2", "h3", "h4", "h5", "h6", "tr", "section", "article"}
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self.title = ""
+        self.canonical = ""
+        self._skip = 0
+        self._in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag in self.SKIP:
+            self._skip += 1
+        elif tag == "title":
+            self._in_title = True
+        elif tag == "link" and attrs.get("rel") == "canonical":
+            self.canonical = attrs.get("href") or ""
+        elif tag == "meta" and attrs.get("property") == "og:url" and not self.canonical:
+            self.canonical = attrs.get("content") or ""
+        if tag in self.BLOCK:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP and self._skip:
+            self._skip -= 1
+        elif tag == "title":
+            self._in_title = False
+        if tag in self.BLOCK:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title += data
+        elif not self._skip:
+            self.parts.append(data)
+
+
+def read_page(path):
+    """(title, canonical url or "", plain text) for one snapshot file."""
+    with open(path, encoding="utf-8", errors="replace") as f:
+        raw = f.read()
+    if not path.lower().endswith((".html", ".htm")):
+        return "", "", raw
+    parser = _TextExtractor()
+    parser.feed(raw)
+    return parser.title.strip(), parser.canonical, "".join(parser.parts)
+
+
+def split_passages(text):
+    """Overlapping windows of about PASSAGE_WORDS words, never spanning a blank line."""
+    passages = []
+    for block in re.split(r"\n\s*\n", text):
+        words = block.split()
+        step = PASSAGE_WORDS - PASSAGE_OVERLAP
+        for start in range(0, max(1, len(words) - PASSAGE_OVERLAP), step):
+            chunk = " ".join(words[start : start + PASSAGE_WORDS])
+            if len(chunk) >= 40:
+                passages.append(chunk)
+    return passages
+
+
+def load_snapshot(snapshot_dir):
+    manifest = {}
+    manifest_path = os.path.join(snapshot_dir, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+
+    docs = []
+    for root, _, files in os.walk(snapshot_dir):
+        for name in sorted(files):
+            if not name.lower().endswith((".html", ".htm", ".txt", ".md")):
+                continue
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, snapshot_dir)
+            title, url, text = read_page(path)
+            meta = manifest.get(rel, {})
+            url = meta.get("url") or url
+            if not url:
+                print(f"skipping {rel}: no URL in manifest.json or canonical link", file=sys.stderr)
+                continue
+            title = meta.get("title") or title or url
+            for passage in split_passages(text):
+                docs.append({"title": title, "url": url, "text": passage})
+    return docs
+
+
+def build_index(docs, out_path, k1=1.2, b=0.75):
+    postings = defaultdict(list)  # term -> [(doc, tf)]
+    doclens = []
+    for doc_id, doc in enumerate(docs):
+        tokens = tokenize(doc["title"] + " " + doc["text"])
+        doclens.append(len(tokens))
+        for term, tf in Counter(tokens).items():
+            postings[term].append((doc_id, tf))
+
+    terms = sorted((term_hash(t), t) for t in postings)
+    term_table = bytearray()
+    posting_blob = bytearray()
+    n_postings = 0
+    for h, term in terms:
+        plist = postings[term]
+        term_table += TERM.pack(h, n_postings, len(plist))
+        for doc_id, tf in plist:
+            posting_blob += POSTING.pack(doc_id, tf)
+        n_postings += len(plist)
+
+    text_blob = bytearray()
+    docoffs = [0]
+    for doc in docs:
+        text_blob += json.dumps(doc, ensure_ascii=False).encode("utf-8")
+        docoffs.append(len(text_blob))
+
+    doclen_blob = struct.pack(f"<{len(doclens)}I", *doclens)
+    docoff_blob = struct.pack(f"<{len(docoffs)}Q", *docoffs)
+    terms_off = HEADER.size
+    postings_off = terms_off + len(term_table)
+    doclens_off = postings_off + len(posting_blob)
+    docoffs_off = doclens_off + len(doclen_blob)
+    text_off = docoffs_off + len(docoff_blob)
+    avgdl = sum(doclens) / len(doclens) if doclens else 1.0
+    header = HEADER.pack(
+        MAGIC, VERSION, len(docs), len(terms), avgdl, k1, b, 0,
+        terms_off, postings_off, doclens_off, docoffs_off, text_off,
+    )
+
+    # Write beside the target and rename, so running workers never map a half-written file.
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        for part in (header, term_table, posting_blob, doclen_blob, docoff_blob, text_blob):
+            f.write(part)
+    os.replace(tmp_path, out_path)
+    return len(docs), len(terms)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="index a local snapshot directory")
+    build.add_argument("snapshot_dir")
+    build.add_argument("-o", "--output", default="ga_index.bin")
+    search = sub.add_parser("search", help="query an index")
+    search.add_argument("index")
+    search.add_argument("query")
+    search.add_argument("-k", type=int, default=4)
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        n_docs, n_terms = build_index(load_snapshot(args.snapshot_dir), args.output)
+        print(f"wrote {args.output}: {n_docs} passages, {n_terms} terms")
+    else:
+        for hit in BM25Index(args.index).search(args.query, args.k):
+            print(f"{hit['score']:7.3f}  {hit['title']}  {hit['url']}\n         {hit['text'][:160]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+"""
+BallotBuddy – request log analytics.
+
+Reads the gzip request log segments the app writes under REQUEST_LOG_DIR in
+one streaming pass and finds the opening questions that dominate traffic, so
+their answers can be computed before anyone asks:
+
+    python3 ballotbuddy_logs.py top /tmp/ballotbuddy-requests -n 30
+    python3 ballotbuddy_logs.py warm-list /tmp/ballotbuddy-requests --since 2026-10-27
+
+Arguments are segment files or directories of them. The app loads
+warm_list.json (WARM_LIST_PATH) and keeps answers to the listed questions in
+its answer and semantic caches.
+
+Questions are grouped by their content words (lowercased, stopwords dropped,
+plurals folded, in any order), so "How do I register to vote?" and "how can
+i register to vote" count as one. Memory does not grow with the log:
+
+    sketch       count-min sketch (depth x width u32 counters, conservative
+                 update) estimating how often each group was asked
+    candidates   the groups with the highest estimates, pruned back to
+                 --track whenever they reach twice that, each with its most
+                 common wordings
+
+Counts can only be overestimated, by at most error_bound (e * counted /
+width) with probability 1 - e^-depth. With --jobs N (default: one per CPU),
+the segments are split between N processes, each with its own sketch, so
+memory is N times the above; sketches and candidates are merged at the end.
+"""
+
+import argparse
+import functools
+import gzip
+import hashlib
+import json
+import math
+import multiprocessing
+import operator
+import os
+import sys
+import time
+import zlib
+from array import array
+from collections import Counter
+from datetime import datetime
+
+from ballotbuddy_index import tokenize
+
+WARM_LIST_VERSION = 1
+
+# Opening questions answered this way would be answered the same way again;
+# FAQ, topic-card and off-topic answers never reach the model anyway.
+COUNTED_OUTCOMES = frozenset(
+    ["miss", "hit", "semantic", "coalesced", "error", "stale", "unavailable"]
+)
+
+MAX_VARIANTS = 8  # wordings kept per candidate
+MEMO_SIZE = 1 << 16  # normalized questions and sketch slots remembered; the head repeats a lot
+
+
+@functools.lru_cache(maxsize=MEMO_SIZE)
+def question_key(question):
+    """Group key: sorted content words, without the ones every question here implies."""
+    words = {w for w in tokenize(question) if len(w) > 1 and w not in ("georgia", "ga")}
+    return " ".join(sorted(words))
+
+
+def wording(question):
+    # The app's answer cache matches questions up to case and whitespace.
+    return " ".join(question.split())
+
+
+# ----------------- SKETCHES -----------------
+
+
+class CountMinSketch:
+    """Approximate counts in fixed memory; never underestimates."""
+
+    def __init__(self, width, depth):
+        if width & (width - 1):
+            raise ValueError("sketch width must be a power of two")
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self._mask = width - 1
+        self._rows = [array("I", bytes(4 * width)) for _ in range(depth)]
+        self._slots = functools.lru_cache(maxsize=MEMO_SIZE)(self._hash_slots)
+
+    def _hash_slots(self, key):
+        # Double hashing: row i uses h1 + i * h2.
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) & self._mask for i in range(self.depth)]
+
+    def add(self, key):
+        """Count one occurrence of `key`; returns its new estimate."""
+        self.total += 1
+        slots = self._slots(key)
+        estimate = min(row[s] for row, s in zip(self._rows, slots)) + 1
+        # Conservative update: raise only the counters that are below the new estimate.
+        for row, s in zip(self._rows, slots):
+            if row[s] < estimate:
+                row[s] = min(estimate, 0xFFFFFFFF)
+        return estimate
+
+    def estimate(self, key):
+        return min(row[s] for row, s in zip(self._rows, self._slots(key)))
+
+    def merge(self, other):
+        """Add the counts of a sketch of the same shape (from another process)."""
+        self.total += other.total
+        for i, (row, other_row) in enumerate(zip(self._rows, other._rows)):
+            summed = map(operator.add, row, other_row)
+            self._rows[i] = array("I", (min(n, 0xFFFFFFFF) for n in summed))
+        self._slots.cache_clear()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["_slots"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._slots = functools.lru_cache(maxsize=MEMO_SIZE)(self._hash_slots)
+
+    def error_bound(self):
+        return math.ceil(math.e * self.total / self.width)
+
+
+class HeavyHitters:
+    """The `track` most frequent keys by sketch estimate, with their common wordings."""
+
+    def __init__(self, sketch, track):
+        self.sketch = sketch
+        self.track = track
+        self.candidates = {}  # key -> Counter of wordings
+        self._floor = 0  # estimate of the weakest candidate kept at the last prune
+
+    def add(self, key, text):
+        estimate = self.sketch.add(key)
+        variants = self.candidates.get(key)
+        if variants is None:
+            if estimate <= self._floor:
+                return  # cannot outrank anything kept so far
+            if len(self.candidates) >= 2 * self.track:
+                self._prune()
+            variants = self.candidates[key] = Counter()
+        if text in variants or len(variants) < MAX_VARIANTS:
+            variants[text] += 1
+        else:
+            # Space-saving: the new wording takes over the rarest one's count.
+            rarest, n = min(variants.items(), key=lambda item: item[1])
+            del variants[rarest]
+            variants[text] = n + 1
+
+    def merge(self, other):
+        """Fold in the sketch and candidates of another scan."""
+        self.sketch.merge(other.sketch)
+        for key, variants in other.candidates.items():
+            mine = self.candidates.setdefault(key, Counter())
+            mine.update(variants)
+            if len(mine) > MAX_VARIANTS:
+                self.candidates[key] = Counter(dict(mine.most_common(MAX_VARIANTS)))
+        self._floor = 0
+        if len(self.candidates) > self.track:
+            self._prune()
+
+    def _prune(self):
+        ranked = sorted(self.candidates, key=self.sketch.estimate, reverse=True)
+        for key in ranked[self.track:]:
+            del self.candidates[key]
+        self._floor = self.sketch.estimate(ranked[self.track - 1])
+
+    def top(self, n):
+        """[(estimate, key, Counter of wordings)], most frequent first."""
+        ranked = [(self.sketch.estimate(k), k, v) for k, v in self.candidates.items()]
+        ranked.sort(key=lambda item: (-item[0], item[1]))
+        return ranked[:n]
+
+
+# ----------------- READING -----------------
+
+
+def segment_files(paths):
+    """Segment files named by `paths` (files or directories), oldest first."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(
+                os.path.join(path, name)
+                for name in os.listdir(path)
+                if name.startswith("requests-") and name.endswith(".jsonl.gz")
+            )
+        else:
+            files.append(path)
+    return files
+
+
+def read_records(files, stats):
+    """Every record in `files`, one at a time. Opening-question records only."""
+    for path in files:
+        try:
+            f = gzip.open(path, "rb")
+        except OSError as e:
+            print(f"skipping {path}: {e}", file=sys.stderr)
+            continue
+        with f:
+            try:
+                for line in f:
+                    stats["records"] += 1
+                    # Cheap filter before parsing: the app writes compact JSON.
+                    if b'"turns":1,' not in line:
+                        continue
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        stats["bad_lines"] += 1
+            except (EOFError, gzip.BadGzipFile, zlib.error):
+                stats["truncated"] += 1  # a segment still being written, or cut by a crash
+        stats["segments"] += 1
+
+
+def scan(files, width, depth, track, since=None, until=None, jobs=1):
+    """Single pass over the segments; returns (HeavyHitters, stats).
+
+    With jobs > 1 the segments are split between that many processes, each
+    with its own sketch, and the results are merged.
+    """
+    jobs = min(jobs, len(files))
+    if jobs > 1:
+        groups = [[] for _ in range(jobs)]
+        sizes = [0] * jobs
+        for path in sorted(files, key=os.path.getsize, reverse=True):
+            i = sizes.index(min(sizes))
+            groups[i].append(path)
+            sizes[i] += os.path.getsize(path)
+        with multiprocessing.Pool(jobs) as pool:
+            results = pool.starmap(
+                scan, [(group, width, depth, track, since, until) for group in groups]
+            )
+        hitters, stats = results[0]
+        for other, other_stats in results[1:]:
+            hitters.merge(other)
+            stats.update(other_stats)
+        return hitters, stats
+
+    stats = Counter(records=0, counted=0, segments=0, bad_lines=0, truncated=0)
+    hitters = HeavyHitters(CountMinSketch(width, depth), track)
+    for record in read_records(files, stats):
+        if record.get("outcome") not in COUNTED_OUTCOMES or record.get("attachments"):
+            continue
+        t = record.get("time", 0)
+        if (since is not None and t < since) or (until is not None and t >= until):
+            continue
+        question = record.get("question") or ""
+        key = question_key(question)
+        if not key:
+            continue
+        stats["counted"] += 1
+        hitters.add(key, wording(question))
+    return hitters, stats
+
+
+def warm_list(hitters, stats, top, min_count):
+    """The warm-list document: ranked questions, each in its most common wording."""
+    questions = []
+    for count, key, variants in hitters.top(top):
+        if count < min_count:
+            break
+        questions.append(
+            {
+                "question": variants.most_common(1)[0][0],
+                "count": count,
+                "key": key,
+                "variants": len(variants),
+            }
+        )
+    return {
+        "version": WARM_LIST_VERSION,
+        "generated": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "records": stats["records"],
+        "counted": stats["counted"],
+        "error_bound": hitters.sketch.error_bound(),
+        "questions": questions,
+    }
+
+
+def write_warm_list(document, out_path):
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(document, f, indent=1)
+        f.write("\n")
+    # Running workers reload the file by mtime, so never let them see half of it.
+    os.replace(tmp_path, out_path)
+
+
+def parse_day(value):
+    return datetime.fromisoformat(value).timestamp()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    top_cmd = sub.add_parser("top", help="print the most asked opening questions")
+    warm_cmd = sub.add_parser("warm-list", help="write the ranked warm-list the app prewarms")
+    warm_cmd.add_argument("-o", "--output", default="warm_list.json")
+    warm_cmd.add_argument("--min-count", type=int, default=5)
+    for cmd, default_top in ((top_cmd, 20), (warm_cmd, 200)):
+        cmd.add_argument("paths", nargs="+", help="segment files or directories")
+        cmd.add_argument("-n", "--top", type=int, default=default_top)
+        cmd.add_argument("--since", type=parse_day, help="ISO date or time, inclusive")
+        cmd.add_argument("--until", type=parse_day, help="ISO date or time, exclusive")
+        cmd.add_argument("--width", type=int, default=1 << 20, help="sketch counters per row")
+        cmd.add_argument("--depth", type=int, default=4)
+        cmd.add_argument("--track", type=int, default=2000, help="candidate groups kept")
+        cmd.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="processes")
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    files = segment_files(args.paths)
+    hitters, stats = scan(
+        files,
+        args.width,
+        args.depth,
+        max(args.track, args.top),
+        args.since,
+        args.until,
+        args.jobs,
+    )
+    elapsed = time.perf_counter() - started
+
+    if args.command == "top":
+        total = max(1, stats["counted"])
+        for rank, (count, key, variants) in enumerate(hitters.top(args.top), 1):
+            text = variants.most_common(1)[0][0]
+            print(f"{rank:4d} {count:9d} {100 * count / total:5.1f}%  {text}")
+    else:
+        document = warm_list(hitters, stats, args.top, args.min_count)
+        write_warm_list(document, args.output)
+        print(f"wrote {args.output}: {len(document['questions'])} questions")
+    print(
+        f"{stats['segments']} segments, {stats['records']} records, "
+        f"{stats['counted']} opening questions counted in {elapsed:.1f}s "
+        f"(counts within +{hitters.sketch.error_bound()})",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
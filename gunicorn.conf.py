@@ -0,0 +1,10 @@
+"""gunicorn settings, read automatically when gunicorn is started from this directory."""
+
+
+def post_worker_init(worker):
+    # Each worker needs its own background threads (topic-card prewarm, warm
+    # list, semantic cache saves, request log writer). Start them as soon as the
+    # worker has loaded the app, so the first visitors already get warm answers.
+    import ballotbuddy_app
+
+    ballotbuddy_app.start_background_tasks()
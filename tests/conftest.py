@@ -0,0 +1,48 @@
+"""Import-time settings for the app module: no API key, files or threads needed."""
+
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_state_dir = tempfile.mkdtemp(prefix="ballotbuddy-tests-")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.update(
+    CACHE_BACKEND="memory",
+    METRICS_DIR=os.path.join(_state_dir, "metrics"),
+    SEMANTIC_CACHE_PATH=os.path.join(_state_dir, "semantic.npz"),
+    REQUEST_LOG_DIR="",
+    WARM_LIST_PATH="",
+    PREWARM_TOPICS="0",
+)
+
+import pytest  # noqa: E402
+
+
+class Clock:
+    """Stands in for time.time() or time.monotonic() so TTLs can be crossed without sleeping."""
+
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = Clock()
+    monkeypatch.setattr("time.time", fake)
+    return fake
+
+
+@pytest.fixture
+def monotonic(monkeypatch):
+    fake = Clock()
+    monkeypatch.setattr("time.monotonic", fake)
+    return fake
@@ -0,0 +1,116 @@
+import asyncio
+import json
+import threading
+
+import pytest
+
+import ballotbuddy_app as app
+
+
+def test_rate_limiter_allows_a_burst_then_refills(monotonic):
+    limiter = app.RateLimiter(60, 2)
+    limiter.check("a")
+    limiter.check("a")
+    with pytest.raises(app.Overloaded) as e:
+        limiter.check("a")
+    assert (e.value.status, e.value.reason, e.value.retry_after) == (429, "rate_limited", 1)
+    limiter.check("b")  # buckets are per client
+    monotonic.advance(1)
+    limiter.check("a")
+    assert limiter.limited == 1
+
+
+def test_a_marked_retry_is_free_once_per_charged_request(monotonic):
+    limiter = app.RateLimiter(60, 1)
+    limiter.check("a")
+    limiter.check("a", retry=True)
+    with pytest.raises(app.Overloaded):
+        limiter.check("a", retry=True)  # the free retry was used up
+    assert limiter.free_retries == 1
+
+
+def test_a_retry_long_after_the_request_is_charged(monotonic):
+    limiter = app.RateLimiter(1, 1)
+    limiter.check("a")
+    monotonic.advance(limiter.RETRY_WINDOW)
+    limiter.check("a", retry=True)  # charged: the bucket refilled one token meanwhile
+    assert limiter.free_retries == 0
+    with pytest.raises(app.Overloaded):
+        limiter.check("a")
+
+
+def test_rate_limiter_is_off_at_zero():
+    limiter = app.RateLimiter(0, 0)
+    for _ in range(100):
+        limiter.check("a")
+
+
+def test_full_queue_is_rejected_at_once():
+    gate = app.AdmissionController(1, 0, 5)
+    slot = gate.acquire()
+    with pytest.raises(app.Overloaded) as e:
+        gate.acquire()
+    assert (e.value.status, e.value.reason) == (503, "queue_full")
+    assert e.value.retry_after == gate.retry_after() >= 1
+    gate.release(slot)
+    gate.release(gate.acquire())
+    stats = gate.stats()
+    assert (stats["admitted"], stats["rejected_queue_full"], stats["active"]) == (2, 1, 0)
+
+
+def test_queued_request_gets_the_next_free_slot():
+    gate = app.AdmissionController(1, 1, 5)
+    slot = gate.acquire()
+    threading.Timer(0.05, gate.release, (slot,)).start()
+    gate.release(gate.acquire())
+    assert gate.stats()["waiting"] == 0
+
+
+def test_queued_request_times_out():
+    gate = app.AdmissionController(1, 1, 0.01)
+    gate.acquire()
+    with pytest.raises(app.Overloaded) as e:
+        gate.acquire()
+    assert e.value.reason == "queue_timeout"
+    assert gate.stats()["waiting"] == 0
+
+
+def test_async_gate_rejects_past_the_queue():
+    gate = app.AdmissionController(1, 1, 0.05)
+
+    async def crowd():
+        slot = await gate.acquire_async()
+        results = await asyncio.gather(
+            gate.acquire_async(), gate.acquire_async(), return_exceptions=True
+        )
+        gate.release_async(slot)
+        return sorted(r.reason for r in results)
+
+    assert asyncio.run(crowd()) == ["queue_full", "queue_timeout"]
+
+
+def post(client, question, **headers):
+    messages = json.dumps([{"role": "user", "content": question}])
+    return client.post("/api/chat", data={"messages": messages}, headers=headers)
+
+
+def test_shed_requests_get_retry_after(monkeypatch):
+    gate = app.AdmissionController(1, 0, 5)
+    gate.acquire()
+    monkeypatch.setattr(app, "upstream_gate", gate)
+    response = post(app.app.test_client(), "Can I wear a campaign shirt to vote?")
+    assert response.status_code == 503
+    data = response.get_json()
+    assert data["error"] == "queue_full"
+    assert response.headers["Retry-After"] == str(data["retry_after"])
+
+
+def test_rate_limited_clients_get_429_but_not_for_the_stream_retry(monkeypatch):
+    monkeypatch.setattr(app, "rate_limiter", app.RateLimiter(1, 1))
+    client = app.app.test_client()
+    # Answered from faq.json, so no model call is needed.
+    assert post(client, "What ID do I need to vote?").status_code == 200
+    assert post(client, "What ID do I need to vote?", **{"X-Chat-Retry": "1"}).status_code == 200
+    response = post(client, "What ID do I need to vote?")
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
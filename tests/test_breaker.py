@@ -0,0 +1,149 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import ballotbuddy_app as app
+
+
+def make_breaker(failure_rate=0.5, min_calls=4, window=60, slow=10, open_for=30, probe_timeout=20):
+    return app.CircuitBreaker(failure_rate, min_calls, window, slow, open_for, probe_timeout)
+
+
+def fail(breaker, n):
+    for _ in range(n):
+        breaker.record(breaker.allow(), False, 1)
+
+
+def trip(breaker, monotonic):
+    """Open the breaker, wait out open_for and take the half-open probe."""
+    fail(breaker, breaker.min_calls)
+    monotonic.advance(breaker.open_for)
+    probe = breaker.allow()
+    assert probe is not None and breaker.state == "half_open"
+    return probe
+
+
+def test_opens_once_enough_calls_fail(monotonic):
+    breaker = make_breaker()
+    fail(breaker, 3)
+    assert breaker.state == "closed"  # fewer than min_calls
+    breaker.record(breaker.allow(), True, 1)
+    assert breaker.state == "open"  # 3 bad out of 4
+    assert breaker.allow() is None
+    assert breaker.stats()["refused"] == 1
+
+
+def test_slow_calls_count_as_failures(monotonic):
+    breaker = make_breaker(min_calls=2)
+    breaker.record(breaker.allow(), True, 10)
+    breaker.record(breaker.allow(), True, 1)
+    assert breaker.state == "open"
+
+
+def test_results_outside_the_window_are_forgotten(monotonic):
+    breaker = make_breaker()
+    fail(breaker, 3)
+    monotonic.advance(61)
+    fail(breaker, 1)
+    assert breaker.state == "closed"
+
+
+def test_half_open_lets_one_probe_through(monotonic):
+    breaker = make_breaker()
+    fail(breaker, 4)
+    monotonic.advance(29)
+    assert breaker.allow() is None
+    monotonic.advance(1)
+    assert breaker.allow() is not None
+    assert breaker.allow() is None  # the probe is still out
+    assert breaker.stats()["probes"] == 1
+
+
+def test_probe_success_closes_the_breaker(monotonic):
+    breaker = make_breaker()
+    probe = trip(breaker, monotonic)
+    breaker.record(probe, True, 1)
+    assert breaker.state == "closed"
+    assert breaker.allow() is app.CircuitBreaker.CLOSED
+
+
+def test_probe_failure_reopens_the_breaker(monotonic):
+    breaker = make_breaker()
+    probe = trip(breaker, monotonic)
+    breaker.record(probe, False, 1)
+    assert breaker.state == "open"
+    assert breaker.stats()["trips"] == 2
+    assert breaker.allow() is None
+
+
+def test_results_of_calls_other_than_the_probe_are_stale(monotonic):
+    breaker = make_breaker()
+    earlier = breaker.allow()  # let through while closed; still running when the breaker opens
+    probe = trip(breaker, monotonic)
+    breaker.record(earlier, True, 1)
+    assert breaker.state == "half_open"
+    breaker.record(earlier, False, 1)
+    assert breaker.state == "half_open"
+    breaker.record(probe, True, 1)
+    assert breaker.state == "closed"
+
+
+def test_a_silent_probe_is_replaced_and_its_late_result_ignored(monotonic):
+    breaker = make_breaker(probe_timeout=20)
+    first = trip(breaker, monotonic)
+    monotonic.advance(20)
+    second = breaker.allow()
+    assert second is not None and second is not first
+    breaker.record(first, False, 1)
+    assert breaker.state == "half_open"
+    breaker.record(second, True, 1)
+    assert breaker.state == "closed"
+
+
+# ----------------- through the chat endpoint -----------------
+
+
+class FakeCompletions:
+    def __init__(self):
+        self.calls = 0
+        self.error = None
+
+    def create(self, **kwargs):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        message = SimpleNamespace(content="Polls are open from 7am to 7pm.")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    fake = FakeCompletions()
+    monkeypatch.setattr(app.client.chat, "completions", fake)
+    monkeypatch.setattr(app, "breaker", make_breaker(min_calls=3))
+    monkeypatch.setattr(app, "answer_cache", app.MemoryCache("answers", 100, 60, stale_ttl=3600))
+    monkeypatch.setattr(app, "semantic_cache", None)
+    return fake
+
+
+def ask(question):
+    messages = json.dumps([{"role": "user", "content": question}])
+    response = app.app.test_client().post("/api/chat", data={"messages": messages})
+    return response.headers["X-Cache"], response.get_json()["answer"]
+
+
+def test_open_breaker_serves_stale_answers_without_calling_the_model(upstream, clock):
+    question = "What time do the polls close on election day?"
+    assert ask(question) == ("miss", "Polls are open from 7am to 7pm.")
+    clock.advance(61)
+    upstream.error = RuntimeError("upstream down")
+
+    outcome, answer = ask(question)
+    assert outcome == "stale" and answer == app.STALE_NOTE + "Polls are open from 7am to 7pm."
+    assert ask("Can I wear a campaign shirt to vote?") == ("error", app.FALLBACK_ANSWER)
+    assert app.breaker.state == "open" and upstream.calls == 3
+
+    assert ask(question)[0] == "stale"
+    assert ask("Can I wear a campaign shirt to vote?") == ("unavailable", app.FALLBACK_ANSWER)
+    assert upstream.calls == 3
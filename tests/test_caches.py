@@ -0,0 +1,149 @@
+import pytest
+
+import ballotbuddy_app as app
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_cache(request, tmp_path):
+    def make(max_entries=10, ttl=60, stale_ttl=0, name="answers"):
+        if request.param == "sqlite":
+            cache = app.SQLiteCache(name, max_entries, ttl, str(tmp_path / "cache.sqlite3"), stale_ttl)
+            cache.PRUNE_EVERY = 1  # enforce the size bound on every write
+            return cache
+        return app.MemoryCache(name, max_entries, ttl, stale_ttl)
+
+    return make
+
+
+def test_get_returns_what_was_set(make_cache, clock):
+    cache = make_cache()
+    assert cache.get("k") is None
+    cache.set("k", {"answer": "yes", "sources": []})
+    assert cache.get("k") == {"answer": "yes", "sources": []}
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+
+
+def test_entries_expire_after_ttl(make_cache, clock):
+    cache = make_cache(ttl=60)
+    cache.set("k", "v")
+    cache.set("short", "v", ttl=5)
+    clock.advance(6)
+    assert cache.get("short") is None
+    assert cache.get("k") == "v"
+    clock.advance(60)
+    assert cache.get("k") is None
+
+
+def test_expired_entries_are_served_stale_only_when_asked(make_cache, clock):
+    cache = make_cache(ttl=60, stale_ttl=100)
+    cache.set("k", "v")
+    clock.advance(61)
+    assert cache.get("k") is None
+    assert cache.get("k", allow_stale=True) == "v"
+    assert cache.stats()["stale_hits"] == 1
+    clock.advance(100)
+    assert cache.get("k", allow_stale=True) is None
+
+
+def test_fresh_entries_are_not_counted_as_stale(make_cache, clock):
+    cache = make_cache(stale_ttl=100)
+    cache.set("k", "v")
+    assert cache.get("k", allow_stale=True) == "v"
+    assert (cache.stats()["hits"], cache.stats()["stale_hits"]) == (1, 0)
+
+
+def test_without_stale_window_expired_entries_are_not_served(make_cache, clock):
+    cache = make_cache(ttl=60)
+    cache.set("k", "v")
+    clock.advance(61)
+    assert cache.get("k", allow_stale=True) is None
+
+
+def test_add_claims_only_absent_or_expired_keys(make_cache, clock):
+    cache = make_cache(ttl=60)
+    assert cache.add("k", {"pid": 1})
+    assert not cache.add("k", {"pid": 2})
+    assert cache.get("k") == {"pid": 1}
+    clock.advance(61)
+    assert cache.add("k", {"pid": 3})
+    assert cache.get("k") == {"pid": 3}
+    cache.delete("k")
+    assert cache.add("k", {"pid": 4})
+
+
+def test_explicit_zero_ttl_is_not_the_default(make_cache, clock):
+    cache = make_cache(ttl=60)
+    cache.set("k", "v", ttl=0)
+    assert cache.add("claim", {"pid": 1}, ttl=0)
+    clock.advance(1)
+    assert cache.get("k") is None
+    assert cache.add("claim", {"pid": 2})
+
+
+def test_add_respects_max_entries(make_cache, clock):
+    cache = make_cache(max_entries=2)
+    for key in "abc":
+        clock.advance(1)
+        assert cache.add(key, {"pid": 1})
+    assert cache.stats()["entries"] == 2
+    assert cache.get("a") is None
+
+
+def test_memory_cache_evicts_least_recently_used(clock):
+    cache = app.MemoryCache("answers", 2, 60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # a is now more recent than b
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert cache.stats()["evictions"] == 1
+
+
+def test_memory_cache_drops_entries_past_the_stale_window(clock):
+    cache = app.MemoryCache("answers", 10, 60, stale_ttl=100)
+    cache.set("k", "v")
+    clock.advance(120)
+    cache.get("k")
+    assert cache.stats()["entries"] == 1  # still inside the stale window
+    clock.advance(50)
+    cache.get("k")
+    assert cache.stats()["entries"] == 0
+
+
+def test_sqlite_cache_evicts_least_recently_used(tmp_path, clock):
+    cache = app.SQLiteCache("answers", 2, 3600, str(tmp_path / "cache.sqlite3"))
+    cache.PRUNE_EVERY = 1
+    cache.set("a", 1)
+    clock.advance(1)
+    cache.set("b", 2)
+    clock.advance(cache.TOUCH_AFTER + 1)
+    assert cache.get("a") == 1  # refreshes a's LRU timestamp
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert cache.stats()["evictions"] == 1
+
+
+def test_sqlite_prune_keeps_entries_inside_the_stale_window(tmp_path, clock):
+    cache = app.SQLiteCache("answers", 10, 60, str(tmp_path / "cache.sqlite3"), stale_ttl=100)
+    cache.PRUNE_EVERY = 1
+    cache.set("old", "v")
+    clock.advance(120)
+    cache.set("new", "v")  # prunes
+    assert cache.get("old", allow_stale=True) == "v"
+    clock.advance(50)
+    cache.set("newer", "v")
+    assert cache.get("old", allow_stale=True) is None
+    assert cache.stats()["entries"] == 2
+
+
+def test_sqlite_cache_is_shared_between_workers(tmp_path, clock):
+    path = str(tmp_path / "cache.sqlite3")
+    first = app.SQLiteCache("answers", 10, 60, path)
+    second = app.SQLiteCache("answers", 10, 60, path)
+    first.set("k", {"answer": "shared"})
+    assert second.get("k") == {"answer": "shared"}
+    assert first.add("claim", {"pid": 1})
+    assert not second.add("claim", {"pid": 2})
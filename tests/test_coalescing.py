@@ -0,0 +1,108 @@
+import asyncio
+import threading
+
+import ballotbuddy_app as app
+
+
+def land_later(flights, key, flight, payload, claimed=False, delay=0.05):
+    timer = threading.Timer(delay, flights.land, (key, flight, payload, claimed))
+    timer.start()
+    return timer
+
+
+def test_first_caller_leads_and_later_callers_follow():
+    flights = app.SingleFlight()
+    leader_flight, role = flights.join("k")
+    assert role == "leader"
+    follower_flight, role = flights.join("k")
+    assert role == "follower" and follower_flight is leader_flight
+    assert flights.join("other")[1] == "leader"
+    assert flights.stats()["in_flight"] == 2
+
+
+def test_followers_get_the_leaders_payload():
+    flights = app.SingleFlight()
+    flight, _ = flights.join("k")
+    flights.join("k")
+    land_later(flights, "k", flight, {"answer": "yes"})
+    assert flight.wait(5) == {"answer": "yes"}
+    assert flights.join("k")[1] == "leader"  # landed flights are retired
+    stats = flights.stats()
+    assert (stats["leaders"], stats["followers"], stats["upstream_calls_saved"]) == (2, 1, 1)
+
+
+def test_async_followers_get_the_leaders_payload():
+    flights = app.SingleFlight()
+    flight, _ = flights.join("k")
+
+    async def follow():
+        land_later(flights, "k", flight, {"answer": "yes"})
+        return await flight.wait_async(5)
+
+    assert asyncio.run(follow()) == {"answer": "yes"}
+
+
+def test_follower_wait_times_out():
+    flights = app.SingleFlight()
+    flight, _ = flights.join("k")
+    assert flight.wait(0.01) is None
+    assert asyncio.run(flight.wait_async(0.01)) is None
+
+
+def test_failed_leader_lands_a_failure_marker():
+    flights = app.SingleFlight()
+    flight, _ = flights.join("k")
+    flights.land("k", flight, app.FLIGHT_FAILED, False)
+    assert flight.wait(0) is app.FLIGHT_FAILED
+    assert flights.stats()["failures"] == 1
+
+
+def test_turn_maps_flight_results_to_cache_kinds():
+    assert app.ChatTurn._coalesced({"answer": "yes"}) == ({"answer": "yes"}, "coalesced")
+    assert app.ChatTurn._coalesced(app.FLIGHT_FAILED) == (None, "failed")
+    assert app.ChatTurn._coalesced(None) == (None, "miss")
+
+
+def make_workers(tmp_path):
+    """Two workers' SingleFlights over one claim table."""
+    path = str(tmp_path / "cache.sqlite3")
+    workers = [app.SingleFlight(app.SQLiteCache("flights", 100, 60, path)) for _ in range(2)]
+    for flights in workers:
+        flights.POLL_INTERVAL = 0.01
+    return workers
+
+
+def test_other_workers_wait_for_the_claiming_worker(tmp_path):
+    first, second = make_workers(tmp_path)
+    flight, role = first.join("k")
+    assert role == "leader"
+    assert second.join("k")[1] == "remote"
+    land_later(first, "k", flight, {"answer": "yes"}, claimed=True)
+    assert second.wait_remote("k", 5) == {"answer": "yes"}
+    assert second.stats()["remote_followers"] == 1
+
+
+def test_other_workers_see_a_remote_failure(tmp_path):
+    first, second = make_workers(tmp_path)
+    flight, _ = first.join("k")
+    second.join("k")
+    land_later(first, "k", flight, app.FLIGHT_FAILED, claimed=True)
+    assert asyncio.run(second.wait_remote_async("k", 5)) is app.FLIGHT_FAILED
+
+
+def test_abandoned_remote_claim_lets_the_waiter_lead(tmp_path):
+    first, second = make_workers(tmp_path)
+    flight, _ = first.join("k")
+    second.join("k")
+    land_later(first, "k", flight, None, claimed=True)
+    assert second.wait_remote("k", 5) is None
+    assert second.stats()["timeouts"] == 0
+
+
+def test_remote_wait_times_out(tmp_path):
+    first, second = make_workers(tmp_path)
+    first.join("k")
+    second.join("k")
+    assert second.wait_remote("k", 0.05) is None
+    assert asyncio.run(second.wait_remote_async("k", 0.05)) is None
+    assert second.stats()["timeouts"] == 2
@@ -0,0 +1,146 @@
+import gzip
+import json
+import math
+import pickle
+import random
+from collections import Counter
+
+import pytest
+
+import ballotbuddy_logs as logs
+
+
+def zipf_stream(n_keys, n_items, seed=0):
+    rng = random.Random(seed)
+    keys = [f"question {i}" for i in range(n_keys)]
+    weights = [1 / (rank + 1) for rank in range(n_keys)]
+    return rng.choices(keys, weights, k=n_items)
+
+
+def test_width_must_be_a_power_of_two():
+    with pytest.raises(ValueError):
+        logs.CountMinSketch(1000, 4)
+
+
+def test_sketch_never_underestimates_and_stays_within_its_error_bound():
+    width, depth = 256, 4
+    sketch = logs.CountMinSketch(width, depth)
+    stream = zipf_stream(5000, 50_000)
+    for key in stream:
+        sketch.add(key)
+    true = Counter(stream)
+    assert sketch.total == len(stream)
+    assert sketch.error_bound() == math.ceil(math.e * len(stream) / width)
+
+    over = [sketch.estimate(key) - n for key, n in true.items()]
+    assert min(over) >= 0
+    # Each estimate exceeds the bound with probability at most e^-depth.
+    beyond = sum(1 for e in over if e > sketch.error_bound())
+    assert beyond <= math.exp(-depth) * len(true)
+
+
+def test_unseen_keys_estimate_low():
+    sketch = logs.CountMinSketch(1 << 12, 4)
+    for key in zipf_stream(100, 1000):
+        sketch.add(key)
+    assert sketch.estimate("never asked") <= sketch.error_bound()
+
+
+def test_merged_sketches_cover_both_streams():
+    stream = zipf_stream(2000, 20_000)
+    halves = [logs.CountMinSketch(512, 4) for _ in range(2)]
+    for i, key in enumerate(stream):
+        halves[i % 2].add(key)
+    merged = halves[0]
+    merged.merge(halves[1])
+    assert merged.total == len(stream)
+    for key, n in Counter(stream).items():
+        assert n <= merged.estimate(key) <= n + 2 * merged.error_bound()
+
+
+def test_sketch_survives_pickling():
+    sketch = logs.CountMinSketch(256, 3)
+    for key in zipf_stream(50, 500):
+        sketch.add(key)
+    copy = pickle.loads(pickle.dumps(sketch))
+    assert copy.estimate("question 0") == sketch.estimate("question 0")
+    copy.add("question 0")
+    assert copy.estimate("question 0") >= sketch.estimate("question 0")
+
+
+def test_heavy_hitters_find_the_most_asked_keys():
+    stream = zipf_stream(5000, 50_000, seed=1)
+    hitters = logs.HeavyHitters(logs.CountMinSketch(1 << 12, 4), track=20)
+    for key in stream:
+        hitters.add(key, key.upper())
+    assert len(hitters.candidates) < 40
+    top = [key for _, key, _ in hitters.top(5)]
+    assert top == [key for key, _ in Counter(stream).most_common(5)]
+
+
+def test_heavy_hitters_keep_a_bounded_set_of_wordings():
+    hitters = logs.HeavyHitters(logs.CountMinSketch(256, 4), track=5)
+    for i in range(50):
+        hitters.add("register vote", "How do I register to vote?")
+        hitters.add("register vote", f"register to vote #{i}")
+    variants = hitters.top(1)[0][2]
+    assert len(variants) <= logs.MAX_VARIANTS
+    assert variants.most_common(1)[0][0] == "How do I register to vote?"
+
+
+def test_merged_heavy_hitters_rank_across_processes():
+    stream = zipf_stream(3000, 30_000, seed=2)
+    parts = [logs.HeavyHitters(logs.CountMinSketch(1 << 12, 4), track=20) for _ in range(3)]
+    for i, key in enumerate(stream):
+        parts[i % 3].add(key, key)
+    for other in parts[1:]:
+        parts[0].merge(other)
+    assert len(parts[0].candidates) <= 20
+    top = [key for _, key, _ in parts[0].top(3)]
+    assert top == [key for key, _ in Counter(stream).most_common(3)]
+
+
+def test_question_key_groups_rewordings():
+    assert logs.question_key("How do I register to vote?") == logs.question_key(
+        "how can i register to vote in Georgia"
+    )
+    assert logs.question_key("Where is early voting in Cobb?") != logs.question_key(
+        "Where is early voting in Fulton?"
+    )
+    assert logs.wording("  How do I\tvote? ") == "How do I vote?"
+
+
+def record(question, outcome="miss", turns=1, attachments=0, time=1000.0):
+    line = {
+        "time": time,
+        "endpoint": "chat",
+        "outcome": outcome,
+        "turns": turns,
+        "attachments": attachments,
+        "question": question,
+    }
+    return (json.dumps(line, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def test_scan_counts_opening_questions_in_segments(tmp_path):
+    lines = [record("How do I register to vote?")] * 3
+    lines += [record("Where do I vote?", outcome="stale")]
+    lines += [record("How do I register to vote?", turns=2)]  # follow-up
+    lines += [record("How do I register to vote?", outcome="faq")]  # never reaches the model
+    lines += [record("What does this PDF say?", attachments=1)]
+    lines += [record("How do I register to vote?", time=5000.0)]
+    (tmp_path / "requests-1.jsonl.gz").write_bytes(gzip.compress(b"".join(lines)))
+    # A segment still being written: its gzip stream is cut short.
+    partial = gzip.compress(record("Where do I vote?") * 50)
+    (tmp_path / "requests-2.jsonl.gz").write_bytes(partial[: len(partial) // 2])
+
+    files = logs.segment_files([str(tmp_path)])
+    assert [p.rsplit("/", 1)[1] for p in files] == ["requests-1.jsonl.gz", "requests-2.jsonl.gz"]
+    hitters, stats = logs.scan(files, 256, 4, 10, until=2000.0)
+    assert stats["truncated"] == 1
+    counts = {key: n for n, key, _ in hitters.top(10)}
+    assert counts[logs.question_key("How do I register to vote?")] == 3
+    assert counts[logs.question_key("Where do I vote?")] >= 1
+
+    document = logs.warm_list(hitters, stats, top=10, min_count=2)
+    assert [q["question"] for q in document["questions"]] == ["How do I register to vote?"]
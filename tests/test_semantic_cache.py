@@ -0,0 +1,146 @@
+import pytest
+
+import ballotbuddy_app as app
+
+np = pytest.importorskip("numpy")
+
+
+def make_cache(capacity=8, ttl=60, stale_ttl=0, path=None, tag="v1"):
+    return app.SemanticCache(
+        capacity, app.SEMANTIC_CACHE_DIM, app.SEMANTIC_CACHE_THRESHOLD, ttl,
+        path=path, tag=tag, stale_ttl=stale_ttl,
+    )
+
+
+def payload(answer):
+    return {"answer": answer, "sources": []}
+
+
+def test_vectors_are_unit_length():
+    cache = make_cache()
+    assert np.linalg.norm(cache.vectorize("How do I register to vote?")) == pytest.approx(1.0)
+    assert not cache.vectorize("?").any()
+
+
+def test_reworded_question_hits(clock):
+    cache = make_cache()
+    cache.set("How do I request an absentee ballot in Georgia?", payload("apply online"))
+    assert cache.get("how do i request absentee ballots") == payload("apply online")
+    assert cache.get("Request an absentee ballot, how do I?") == payload("apply online")
+    assert cache.stats()["hits"] == 2
+
+
+def test_different_content_words_miss(clock):
+    cache = make_cache()
+    cache.set("Where is early voting in Cobb County?", payload("cobb"))
+    assert cache.get("Where is early voting in Fulton County?") is None
+    assert cache.get("Where is early voting?") is None
+    assert cache.stats()["misses"] == 2
+
+
+def test_question_without_content_words_is_ignored(clock):
+    cache = make_cache()
+    cache.set("Georgia?", payload("anything"))
+    assert cache.stats()["entries"] == 0
+    assert cache.get("GA") is None
+
+
+def test_setting_a_rewording_replaces_the_row(clock):
+    cache = make_cache()
+    cache.set("How do I register to vote?", payload("old"))
+    cache.set("how do i register to vote", payload("new"))
+    assert cache.stats()["entries"] == 1
+    assert cache.get("How do I register to vote?") == payload("new")
+
+
+def test_rows_expire_and_are_served_stale_only_when_asked(clock):
+    cache = make_cache(ttl=60, stale_ttl=100)
+    cache.set("Can I vote with an expired license?", payload("yes"))
+    clock.advance(61)
+    assert cache.get("Can I vote with an expired license?") is None
+    assert cache.get("Can I vote with an expired license?", allow_stale=True) == payload("yes")
+    assert cache.stats()["stale_hits"] == 1
+    clock.advance(100)
+    assert cache.get("Can I vote with an expired license?", allow_stale=True) is None
+
+
+def test_full_cache_overwrites_least_recently_used_row(clock):
+    cache = make_cache(capacity=2)
+    cache.set("When do polls open?", payload("7am"))
+    clock.advance(1)
+    cache.set("Where is my polling place?", payload("mvp"))
+    clock.advance(1)
+    assert cache.get("When do polls open?") == payload("7am")
+    clock.advance(1)
+    cache.set("What ID do I need?", payload("photo id"))
+    assert cache.stats()["evictions"] == 1
+    assert cache.get("Where is my polling place?") is None
+    assert cache.get("When do polls open?") == payload("7am")
+    assert cache.get("What ID do I need?") == payload("photo id")
+
+
+def test_expired_rows_are_reused_before_evicting(clock):
+    cache = make_cache(capacity=2, ttl=60)
+    cache.set("When do polls open?", payload("7am"))
+    clock.advance(61)
+    cache.set("Where is my polling place?", payload("mvp"))
+    cache.set("What ID do I need?", payload("photo id"))
+    assert cache.stats()["evictions"] == 0
+    assert cache.get("Where is my polling place?") == payload("mvp")
+
+
+def test_save_and_load_round_trip(tmp_path, clock):
+    path = str(tmp_path / "semantic.npz")
+    cache = make_cache(path=path)
+    cache.set("How do I register to vote?", payload("online"))
+    cache.set("When do polls open?", payload("7am"))
+    cache.save()
+    assert not cache.dirty
+
+    restored = make_cache(path=path)
+    assert restored.get("how do i register to vote") == payload("online")
+    assert restored.stats()["entries"] == 2
+    assert make_cache(path=path, tag="v2").stats()["entries"] == 0
+
+
+def test_load_keeps_the_most_recently_used_rows(tmp_path, clock):
+    path = str(tmp_path / "semantic.npz")
+    cache = make_cache(path=path)
+    for i, question in enumerate(["When do polls open?", "What ID do I need?", "Where do I vote?"]):
+        clock.advance(1)
+        cache.set(question, payload(str(i)))
+    cache.save()
+    smaller = make_cache(capacity=2, path=path)
+    assert smaller.get("When do polls open?") is None
+    assert smaller.get("Where do I vote?") == payload("2")
+
+
+def test_workers_saving_to_one_file_keep_each_others_rows(tmp_path, clock):
+    path = str(tmp_path / "semantic.npz")
+    first, second = make_cache(path=path), make_cache(path=path)
+    first.set("How do I register to vote?", payload("first"))
+    second.set("When do polls open?", payload("7am"))
+    clock.advance(1)
+    second.set("how do i register to vote", payload("second"))
+    first.save()
+    second.save()
+
+    restored = make_cache(path=path)
+    assert restored.stats()["entries"] == 2  # one row per question
+    assert restored.get("When do polls open?") == payload("7am")
+    assert restored.get("How do I register to vote?") == payload("second")
+
+
+def test_merged_file_keeps_the_most_recently_used_rows(tmp_path, clock):
+    path = str(tmp_path / "semantic.npz")
+    first, second = make_cache(capacity=2, path=path), make_cache(capacity=2, path=path)
+    first.set("When do polls open?", payload("old"))
+    clock.advance(1)
+    second.set("What ID do I need?", payload("id"))
+    second.set("Where do I vote?", payload("mvp"))
+    first.save()
+    second.save()
+
+    restored = make_cache(capacity=2, path=path)
+    assert restored.get("When do polls open?") is None
+    assert restored.get("Where do I vote?") == payload("mvp")
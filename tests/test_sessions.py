@@ -0,0 +1,46 @@
+import json
+
+import pytest
+
+import ballotbuddy_app as app
+
+# Answered from faq.json, so no model call is needed.
+QUESTION = "What ID do I need to vote?"
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+def ask(client, **fields):
+    response = client.post("/api/chat", data=fields)
+    return response.status_code, response.get_json()
+
+
+def test_stateless_requests_do_not_create_sessions(client):
+    before = app.session_store.stats()["entries"]
+    status, data = ask(client, messages=json.dumps([{"role": "user", "content": QUESTION}]))
+    assert status == 200 and data["answer"]
+    assert data["session_id"] is None
+    assert app.session_store.stats()["entries"] == before
+
+
+def test_clients_opt_in_to_a_session(client):
+    messages = json.dumps([{"role": "user", "content": QUESTION}])
+    status, data = ask(client, messages=messages, start_session="1")
+    assert status == 200 and data["session_id"]
+    history = app.session_store.get(data["session_id"])
+    assert [m["role"] for m in history] == ["user", "assistant"]
+
+    messages, session_id = app.load_conversation(
+        {"session_id": data["session_id"], "message": "And on election day?"}
+    )
+    assert session_id == data["session_id"]
+    assert messages[-1] == {"role": "user", "content": "And on election day?"}
+    assert len(messages) == 3
+
+
+def test_unknown_session_is_expired(client):
+    status, data = ask(client, session_id="no-such-session", message=QUESTION)
+    assert status == 409 and data == app.SESSION_EXPIRED
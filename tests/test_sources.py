@@ -0,0 +1,90 @@
+import json
+
+import pytest
+
+import ballotbuddy_app as app
+
+
+def matcher(*phrases):
+    return app.KeywordMatcher((tuple(app.source_tokens(p)), p) for p in phrases)
+
+
+def test_source_tokens_are_lowercase_words():
+    assert app.source_tokens("Driver's License, DDS!") == ["driver", "s", "license", "dds"]
+
+
+def test_finds_every_phrase_including_overlaps_and_suffixes():
+    m = matcher("voter id", "free voter id", "id", "id card", "polling place")
+    found = list(m.find(app.source_tokens("How do I get a free voter ID card?")))
+    assert sorted(found) == ["free voter id", "id", "id card", "voter id"]
+
+
+def test_follows_failure_links_after_a_partial_match():
+    m = matcher("early voting location", "voting hours")
+    found = list(m.find(app.source_tokens("early voting hours")))
+    assert found == ["voting hours"]
+
+
+def test_counts_each_occurrence_and_ignores_partial_phrases():
+    m = matcher("absentee ballot", "my voter page")
+    text = "absentee ballot or another absentee ballot on my voter"
+    assert list(m.find(app.source_tokens(text))) == ["absentee ballot", "absentee ballot"]
+
+
+def test_empty_phrases_never_match():
+    m = matcher("", "runoff")
+    assert list(m.find(["a", "runoff"])) == ["runoff"]
+
+
+@pytest.fixture
+def catalog(tmp_path, monkeypatch):
+    entries = [
+        {"name": "Elections", "url": "https://example.gov/elections", "default": True,
+         "keywords": ["election day"]},
+        {"name": "My Voter Page", "url": "https://example.gov/mvp",
+         "keywords": ["polling place", "sample ballot"]},
+        {"name": "Voter ID", "url": "https://example.gov/id", "keywords": ["photo id"]},
+        {"name": "Absentee", "url": "https://example.gov/absentee", "keywords": ["absentee ballot"]},
+    ]
+    path = tmp_path / "sources.json"
+    path.write_text(json.dumps(entries), encoding="utf-8")
+    monkeypatch.setattr(app, "source_catalog", app.ReloadingFile(str(path), app.compile_sources, 0))
+    return path
+
+
+def urls(sources):
+    return [s["url"].rsplit("/", 1)[1] for s in sources]
+
+
+def test_question_matches_outrank_answer_matches(catalog):
+    sources = app.match_sources(
+        "Where is my polling place?", "Bring a photo ID to your polling place on election day."
+    )
+    assert urls(sources) == ["mvp", "elections", "id"]  # ties keep catalog order
+
+
+def test_retrieved_pages_come_first_and_links_are_not_repeated(catalog):
+    passages = [{"title": "Absentee voting", "url": "https://example.gov/absentee"}]
+    sources = app.match_sources("absentee ballot", "Request an absentee ballot online.", passages)
+    assert urls(sources) == ["absentee", "elections"]
+    assert sources[0]["name"] == "Absentee voting"
+
+
+def test_defaults_fill_in_when_nothing_matches(catalog):
+    assert urls(app.match_sources("hello", "hi")) == ["elections"]
+
+
+def test_missing_catalog_falls_back_to_built_in_links(tmp_path, monkeypatch):
+    missing = app.ReloadingFile(str(tmp_path / "none.json"), app.compile_sources, 0)
+    monkeypatch.setattr(app, "source_catalog", missing)
+    assert app.match_sources("polling place", "") == app.DEFAULT_SOURCES
+
+
+def test_catalog_is_recompiled_when_the_file_changes(catalog):
+    assert urls(app.match_sources("photo id", "")) == ["id", "elections"]
+    entries = json.loads(catalog.read_text(encoding="utf-8"))
+    entries[2]["keywords"] = ["passport"]
+    catalog.write_text(json.dumps(entries), encoding="utf-8")
+    app.source_catalog._mtime = None  # the rewrite may land within the same mtime tick
+    assert urls(app.match_sources("photo id", "")) == ["elections"]
+    assert urls(app.match_sources("passport", "")) == ["id", "elections"]